@@ -1,60 +1,63 @@
-import re
+import copy
+import functools
+import types
 import typing
 import inspect
 from django.contrib import admin
 from .models import ChatHistory, PromptTemplate, Tool
+from .tool_code import compile_tool
 from django.core.exceptions import ValidationError
-from codemirror2.widgets import CodeMirrorEditor
 from django import forms
-from typing import Optional, get_args, get_origin
-from docstring_parser import parse
+from typing import Callable, Optional, get_args, get_origin
+from weakref import WeakKeyDictionary
+
+# Mapping of Python types to JSON schema types
+_JSON_SCHEMA_TYPE_MAP = types.MappingProxyType(
+    {
+        int: "integer",
+        str: "string",
+        bool: "boolean",
+        float: "number",
+        list[str]: "array",
+        # Add more mappings as needed
+    }
+)
+
+# Keyed weakly so that callables created from tool code can still be collected
+_sig_cache: WeakKeyDictionary[Callable, inspect.Signature] = WeakKeyDictionary()
 
 
 class ToolAdminForm(forms.ModelForm):
     class Meta:
         model = Tool
-        widgets = {
-            "tool_code": CodeMirrorEditor(
-                options={"mode": "javascript", "cols": 80}, themes=["neat"]
-            ),
-        }
         fields = "__all__"
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Imported here so that loading the admin module doesn't pull in codemirror2
+        from codemirror2.widgets import CodeMirrorEditor
+
+        self.fields["tool_code"].widget = CodeMirrorEditor(
+            options={"mode": "javascript", "cols": 80}, themes=["neat"]
+        )
+
     def clean(self):
         cleaned_data = super().clean()
-
-        def convert_to_function(source_code: str):
-            match = re.search(r"def\s+(\w+)\s*\(", source_code)
-            if match:
-                function_name = match.group(1)
-            else:
-                raise ValueError(
-                    "No valid function definition found in the provided source code."
-                )
-            # Execute the source code in the current local scope
-            exec(source_code, locals())
-            # Retrieve and return the function by the extracted name
-            return locals()[function_name]
-
-        tool_callable = convert_to_function(cleaned_data.get("tool_code"))
         try:
-            schema = generate_schema(tool_callable)
-            context_params = [
-                param
-                for param in schema["parameters"]["required"]
-                if param.startswith("__") and param.endswith("__")
-            ]
-
-            # Filter out parameters with names in the format __{name}__
-            required_params = [
-                param
-                for param in schema["parameters"]["required"]
-                if not param.startswith("__") and not param.endswith("__")
-            ]
-            required_properties = {
-                param: schema["parameters"]["properties"][param]
-                for param in required_params
-            }
+            # Copy so that the filtering below doesn't mutate the cached schema
+            schema = copy.deepcopy(
+                _generate_schema_from_source(cleaned_data.get("tool_code"))
+            )
+            # Split out parameters with names in the format __{name}__ in one pass
+            properties = schema["parameters"]["properties"]
+            context_params, required_params, required_properties = [], [], {}
+            is_context_param = _is_context_param
+            for param in schema["parameters"]["required"]:
+                if is_context_param(param):
+                    context_params.append(param)
+                else:
+                    required_params.append(param)
+                    required_properties[param] = properties[param]
 
             schema["parameters"]["properties"] = required_properties
             schema["parameters"]["required"] = required_params
@@ -66,14 +69,64 @@ class ToolAdminForm(forms.ModelForm):
         return cleaned_data
 
 
+def _is_context_param(param: str) -> bool:
+    # Context params are named __{name}__, a bare "__" or "___" is not one
+    return len(param) >= 4 and param.startswith("__") and param.endswith("__")
+
+
+def _lru_cache_hashable(maxsize: int):
+    """
+    functools.lru_cache for single-argument functions, that calls the function
+    uncached when the argument is unhashable (e.g. Annotated[int, {}]) instead of
+    raising TypeError from the cache lookup.
+    """
+
+    def decorator(function):
+        cached_function = functools.lru_cache(maxsize=maxsize)(function)
+
+        @functools.wraps(function)
+        def wrapper(arg):
+            try:
+                hash(arg)
+            except TypeError:
+                return function(arg)
+            return cached_function(arg)
+
+        wrapper.cache_info = cached_function.cache_info
+        wrapper.cache_clear = cached_function.cache_clear
+        return wrapper
+
+    return decorator
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_docstring(docstring: str):
+    # Imported lazily, docstring_parser is only needed when tools are edited
+    from docstring_parser import parse
+
+    return parse(docstring)
+
+
+@functools.lru_cache(maxsize=256)
+def _generate_schema_from_source(source_code: str) -> dict:
+    """
+    Builds the JSON schema for the tool defined in source_code.
+    Cached by source code, callers must not mutate the returned dict.
+    """
+    return generate_schema(compile_tool(source_code))
+
+
+@_lru_cache_hashable(maxsize=256)
 def is_optional(annotation):
-    # Check if the annotation is a Union
-    if getattr(annotation, "__origin__", None) is typing.Union:
+    # Check if the annotation is a Union, either typing.Union or the X | Y syntax
+    origin = get_origin(annotation)
+    if origin is typing.Union or origin is types.UnionType:
         # Check if None is one of the options in the Union
-        return type(None) in annotation.__args__
+        return type(None) in get_args(annotation)
     return False
 
 
+@_lru_cache_hashable(maxsize=256)
 def optional_length(annotation):
     if is_optional(annotation):
         # Subtract 1 to account for NoneType
@@ -82,6 +135,7 @@ def optional_length(annotation):
         raise ValueError("The annotation is not an Optional type")
 
 
+@_lru_cache_hashable(maxsize=256)
 def type_to_json_schema_type(py_type):
     """
     Maps a Python type to a JSON schema type.
@@ -98,29 +152,25 @@ def type_to_json_schema_type(py_type):
         # Extract and map the inner type
         return type_to_json_schema_type(type_args[0])
 
-    # Mapping of Python types to JSON schema types
-    type_map = {
-        int: "integer",
-        str: "string",
-        bool: "boolean",
-        float: "number",
-        list[str]: "array",
-        # Add more mappings as needed
-    }
-    if py_type not in type_map:
-        raise ValueError(f"Python type {py_type} has no corresponding JSON schema type")
-
-    return type_map.get(py_type, "string")  # Default to "string" if type not in map
+    try:
+        return _JSON_SCHEMA_TYPE_MAP[py_type]
+    except (KeyError, TypeError):
+        raise ValueError(
+            f"Python type {py_type} has no corresponding JSON schema type"
+        ) from None
 
 
 def generate_schema(
     function, name: Optional[str] = None, description: Optional[str] = None
 ):
     # Get the signature of the function
-    sig = inspect.signature(function)
+    sig = _sig_cache.get(function)
+    if sig is None:
+        sig = _sig_cache.setdefault(function, inspect.signature(function))
 
     # Parse the docstring
-    docstring = parse(function.__doc__)
+    docstring = _parse_docstring(function.__doc__ or "")
+    param_docs = {d.arg_name: d for d in docstring.params}
 
     # Prepare the schema dictionary
     schema = {
@@ -143,9 +193,7 @@ def generate_schema(
             )
 
         # Find the parameter's description in the docstring
-        param_doc = next(
-            (d for d in docstring.params if d.arg_name == param.name), None
-        )
+        param_doc = param_docs.get(param.name)
 
         # Assert that the parameter has a description
         if not param_doc or not param_doc.description:
@@ -158,20 +206,11 @@ def generate_schema(
         # else:
         #
         # Add parameter details to the schema
-        param_doc = next(
-            (d for d in docstring.params if d.arg_name == param.name), None
-        )
         schema["parameters"]["properties"][param.name] = {
             # "type": "string" if param.annotation == str else str(param.annotation),
-            "type": (
-                type_to_json_schema_type(param.annotation)
-                if param.annotation != inspect.Parameter.empty
-                else "string"
-            ),
+            "type": type_to_json_schema_type(param.annotation),
             "description": param_doc.description,
         }
-        if param.default == inspect.Parameter.empty:
-            schema["parameters"]["required"].append(param.name)
 
         if get_origin(param.annotation) is list:
             if get_args(param.annotation)[0] is str:
@@ -179,7 +218,8 @@ def generate_schema(
                     "type": "string"
                 }
 
-        if param.annotation == inspect.Parameter.empty:
+        # Annotation is guaranteed above, so only the default decides this
+        if param.default == inspect.Parameter.empty:
             schema["parameters"]["required"].append(param.name)
 
     # append the heartbeat
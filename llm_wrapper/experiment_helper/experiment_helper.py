@@ -1,11 +1,25 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional
+from collections import OrderedDict
+import functools
+import threading
+from typing import Dict, Any, Optional, Tuple
 import logging
+import time
 from datetime import datetime
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=1)
+def _get_env() -> str:
+    # Resolved once, and lazily so that importing this module doesn't need configured settings
+    return settings.ENV
+
+# How long a fetched variant is reused when capturing events for the same flag and user
+VARIANT_CACHE_TTL_SECONDS = 60
+# Max (flag_key, user_id) pairs whose variant is remembered, oldest written are dropped first
+VARIANT_CACHE_MAX_SIZE = 10000
+
 class ExperimentationClientInterface(ABC):
     @abstractmethod
     def get_feature_flag_payload(self, flag_key: str, user_id: str) -> Dict[str, Any] | None:
@@ -15,9 +29,16 @@ class ExperimentationClientInterface(ABC):
     def get_feature_flag_variant_name(self, flag_key: str, user_id: str) -> str | None:
         pass
 
+    def get_feature_flag_value(self, flag_key: str, user_id: str) -> Any:
+        """
+        Raw flag value as the data sink would record it (e.g. True/False for boolean flags).
+        Optional: clients that don't override this raise NotImplementedError and their variants are not cached.
+        """
+        raise NotImplementedError
+
 class DataSinkInterface(ABC):
     @abstractmethod
-    def capture_data(self, *, flag_key: str, user_id: str, event_name: str, event_properties: Dict[str, Any], timestamp: datetime|None=None) -> None:
+    def capture_data(self, *, flag_key: str, user_id: str, event_name: str, event_properties: Dict[str, Any], timestamp: datetime|None=None, variant_name: Any=None) -> None:
         pass
 
 class ExperimentHelper:
@@ -26,11 +47,21 @@ class ExperimentHelper:
         experimentation_client: Optional[ExperimentationClientInterface] = None,
         data_sink_client: Optional[DataSinkInterface] = None
     ):
-        # Import here to avoid circular imports
-        from .posthog_clients import get_posthog_experimentation_client, get_posthog_datasink_client
-        
-        self.experimentation_client = experimentation_client or get_posthog_experimentation_client()
-        self.data_sink_client = data_sink_client or get_posthog_datasink_client()
+        if experimentation_client is None or data_sink_client is None:
+            # Import here to avoid circular imports
+            from .posthog_clients import get_posthog_experimentation_client, get_posthog_datasink_client
+
+            if experimentation_client is None:
+                experimentation_client = get_posthog_experimentation_client()
+            if data_sink_client is None:
+                data_sink_client = get_posthog_datasink_client()
+
+        self.experimentation_client = experimentation_client
+        self.data_sink_client = data_sink_client
+        # (flag_key, user_id) -> (expiry as time.monotonic(), raw flag value)
+        self._variant_cache: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = OrderedDict()
+        # The default helper is shared by the whole process, so guard the cache across threads
+        self._variant_cache_lock = threading.Lock()
 
     def get_feature_flag_payload(self, *, flag_key: str, user_id: str) -> Dict[str, Any]:
         payload = self.experimentation_client.get_feature_flag_payload(flag_key, user_id)
@@ -40,12 +71,45 @@ class ExperimentHelper:
         return payload
     
     def get_feature_flag_variant_name(self, *, flag_key: str, user_id: str) -> str | None:
-        variant_name = self.experimentation_client.get_feature_flag_variant_name(flag_key, user_id)
+        try:
+            flag_value = self.experimentation_client.get_feature_flag_value(flag_key, user_id)
+        except (AttributeError, NotImplementedError):
+            # Without the raw value the sink must look the flag up itself, so nothing is cached
+            variant_name = self.experimentation_client.get_feature_flag_variant_name(flag_key, user_id)
+        else:
+            variant_name = None if flag_value is None else str(flag_value)
+            if flag_value is not None:
+                self._cache_variant_name(flag_key, user_id, flag_value)
         if variant_name is None:
             logger.error(f"Feature flag payload not found for {flag_key} and user {user_id}")
             return None
         return variant_name
 
+    def _cache_variant_name(self, flag_key: str, user_id: str, variant_name: Any) -> None:
+        key = (flag_key, user_id)
+        now = time.monotonic()
+        with self._variant_cache_lock:
+            self._variant_cache[key] = (now + VARIANT_CACHE_TTL_SECONDS, variant_name)
+            self._variant_cache.move_to_end(key)
+            # Entries are kept in last-write order, so expired ones are at the front
+            while self._variant_cache:
+                oldest_key, (expiry, _) = next(iter(self._variant_cache.items()))
+                if expiry >= now and len(self._variant_cache) <= VARIANT_CACHE_MAX_SIZE:
+                    break
+                self._variant_cache.pop(oldest_key, None)
+
+    def _get_cached_variant_name(self, flag_key: str, user_id: str) -> Any:
+        key = (flag_key, user_id)
+        cached = self._variant_cache.get(key)
+        if cached is None:
+            return None
+        expiry, variant_name = cached
+        if expiry < time.monotonic():
+            with self._variant_cache_lock:
+                self._variant_cache.pop(key, None)
+            return None
+        return variant_name
+
     def capture_data(
         self,
         *,
@@ -55,5 +119,20 @@ class ExperimentHelper:
         event_properties: Dict[str, Any],
         timestamp: datetime|None=None
     ) -> None:
-        event_properties["env"] = settings.ENV
-        self.data_sink_client.capture_data(flag_key=flag_key, user_id=user_id, event_name=event_name, event_properties=event_properties, timestamp=timestamp)
+        # Copied so that the caller's dict is left untouched
+        properties = {**event_properties, "env": _get_env()}
+        capture_kwargs = {}
+        variant_name = self._get_cached_variant_name(flag_key, user_id)
+        if variant_name is not None:
+            # Only passed when known, so sinks without the variant_name parameter keep working
+            capture_kwargs["variant_name"] = variant_name
+        self.data_sink_client.capture_data(flag_key=flag_key, user_id=user_id, event_name=event_name, event_properties=properties, timestamp=timestamp, **capture_kwargs)
+
+
+@functools.lru_cache(maxsize=1)
+def get_default_experiment_helper() -> ExperimentHelper:
+    """
+    Shared ExperimentHelper using the default PostHog clients.
+    Callers that need other clients should construct ExperimentHelper with them directly.
+    """
+    return ExperimentHelper()
@@ -1,4 +1,4 @@
-import json
+import orjson
 from typing import Dict, Any
 from posthog import Posthog
 from django.conf import settings
@@ -18,7 +18,7 @@ def get_posthog_client() -> Posthog:
             poll_interval=30,
             personal_api_key=settings.POSTHOG_PERSONAL_API_KEY
         )
-        print(_posthog_client.__dict__,"_posthog_client")
+        logger.debug("posthog client initialized")
     return _posthog_client
 
 _posthog_experimentation_client = None
@@ -43,22 +43,26 @@ class PosthogExperimentationClient(ExperimentationClientInterface):
     def get_feature_flag_payload(self, flag_key: str, user_id: str) -> Dict[str, Any] | None:
         payload = self.posthog.get_feature_flag_payload(flag_key, distinct_id=user_id)
         if payload is not None:
-            return json.loads(payload)
+            return orjson.loads(payload)
         return None
     
     def get_feature_flag_variant_name(self, flag_key: str, user_id: str) -> str | None:
-        variant_name = self.posthog.get_feature_flag(flag_key, distinct_id=user_id)
+        variant_name = self.get_feature_flag_value(flag_key, user_id)
         if variant_name is not None:
             return str(variant_name)
         return None
+
+    def get_feature_flag_value(self, flag_key: str, user_id: str) -> Any:
+        return self.posthog.get_feature_flag(flag_key, distinct_id=user_id)
         
 
 class PosthogDatasinkClient(DataSinkInterface):
     def __init__(self):
         self.posthog = get_posthog_client()
 
-    def capture_data(self, *, flag_key: str, user_id: str, event_name: str, event_properties: Dict[str, Any], timestamp: datetime|None=None) -> None:
-        variant_name = self.posthog.get_feature_flag(flag_key, distinct_id=user_id)
+    def capture_data(self, *, flag_key: str, user_id: str, event_name: str, event_properties: Dict[str, Any], timestamp: datetime|None=None, variant_name: Any=None) -> None:
+        if variant_name is None:
+            variant_name = self.posthog.get_feature_flag(flag_key, distinct_id=user_id)
         properties = {
             f"$feature/{flag_key}": variant_name,
             **event_properties
@@ -1,3 +1,5 @@
+import functools
+
 from django.db import models
 
 
@@ -13,6 +15,15 @@ class Tool(models.Model):
     def __str__(self):
         return self.name
 
+    @functools.cached_property
+    def parsed_spec(self) -> tuple:
+        """
+        (param_name, param_schema) pairs of tool_json_spec, computed once per instance.
+        Not refreshed if tool_json_spec is changed on the same instance.
+        """
+        properties = self.tool_json_spec.get("parameters", {}).get("properties", {})
+        return tuple(properties.items())
+
 
 class LLMConfigName(models.Model):
     name = models.CharField(max_length=100, primary_key=True)
@@ -6,19 +6,120 @@ from openai.types import FileObject
 from openai.types.beta.threads.run import Run
 from pydantic import BaseModel
 import logging
+from typing import Iterator, Literal
 import litellm
 
 
 class OpenAIService:
+    # Routers keyed by the deployment part of llm_config_params, so that provider
+    # resolution and HTTP clients are reused across calls with the same config
+    _router_cache: dict[frozenset, litellm.Router] = {}
+    # Params that vary per prompt rather than per deployment, passed on each call
+    _PER_CALL_PARAMS = ("tools",)
+
+    @staticmethod
+    def _hashable(value):
+        try:
+            hash(value)
+            return value
+        except TypeError:
+            return repr(value)
+
+    @classmethod
+    def _get_router(cls, llm_config_params: dict) -> tuple[litellm.Router, dict]:
+        deployment_params = {
+            key: value
+            for key, value in llm_config_params.items()
+            if key not in cls._PER_CALL_PARAMS
+        }
+        call_params = {
+            key: llm_config_params[key]
+            for key in cls._PER_CALL_PARAMS
+            if key in llm_config_params
+        }
+        key = frozenset(
+            (name, cls._hashable(value)) for name, value in deployment_params.items()
+        )
+        router = cls._router_cache.get(key)
+        if router is None:
+            router = cls._router_cache[key] = litellm.Router(
+                model_list=[
+                    {
+                        "model_name": deployment_params["model"],
+                        "litellm_params": deployment_params,
+                    }
+                ],
+                # Failover between configs is handled by the callers, so fail on the
+                # first error like a plain litellm.completion call would
+                num_retries=0,
+                disable_cooldowns=True,
+            )
+        call_params["model"] = deployment_params["model"]
+        return router, call_params
+
     @staticmethod
     def send_messages_and_get_response(
         messages: list,
         llm_config_params: dict,
         response_format_class: type[BaseModel] | None = None,
+        return_mode: Literal["choice", "message", "content"] = "choice",
     ):
-        response = litellm.completion(
-            **llm_config_params,
+        router, call_params = OpenAIService._get_router(llm_config_params)
+        response = router.completion(
+            **call_params,
             messages=messages,
             response_format=response_format_class
         )
-        return response["choices"][0]
+        return OpenAIService._extract_from_response(
+            response, response_format_class, return_mode
+        )
+
+    @staticmethod
+    async def asend_messages_and_get_response(
+        messages: list,
+        llm_config_params: dict,
+        response_format_class: type[BaseModel] | None = None,
+        return_mode: Literal["choice", "message", "content"] = "choice",
+    ):
+        router, call_params = OpenAIService._get_router(llm_config_params)
+        response = await router.acompletion(
+            **call_params,
+            messages=messages,
+            response_format=response_format_class
+        )
+        return OpenAIService._extract_from_response(
+            response, response_format_class, return_mode
+        )
+
+    @staticmethod
+    def stream_messages(
+        messages: list,
+        llm_config_params: dict,
+        response_format_class: type[BaseModel] | None = None,
+    ) -> Iterator:
+        router, call_params = OpenAIService._get_router(llm_config_params)
+        response = router.completion(
+            **call_params,
+            messages=messages,
+            response_format=response_format_class,
+            stream=True
+        )
+        for chunk in response:
+            yield chunk
+
+    @staticmethod
+    def _extract_from_response(response, response_format_class, return_mode):
+        choice = response.choices[0]
+        if return_mode == "choice":
+            return choice
+        message = choice.message
+        if return_mode == "message":
+            return message
+        if return_mode == "content":
+            if response_format_class is not None:
+                # Use the provider-parsed object when there is one
+                parsed = getattr(message, "parsed", None)
+                if parsed is not None:
+                    return parsed
+            return message.content
+        raise ValueError(f"Unsupported return_mode: {return_mode}")
@@ -1,10 +1,13 @@
-import re
+import functools
 import typing
-from datetime import datetime
+import os
 import random
+import time
 from string import Template
 import logging
 import json
+import msgspec
+import orjson
 import openai
 from .llm_classes.LLMConfig import GLOBAL_LOADED_LLM_CONFIGS, LLMConfig
 from .models import (
@@ -14,14 +17,93 @@ from .models import (
     Tool,
 )
 from .openai_service import OpenAIService
+from .tool_code import compile_tool
 from pydantic import BaseModel
 from django.conf import settings
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
 import posthog
 
-from .experiment_helper.experiment_helper import ExperimentHelper
+from .experiment_helper.experiment_helper import get_default_experiment_helper
 
 logger = logging.getLogger(__name__)
 
+# Prompt templates change rarely, so they are reused in-process for this long
+PROMPT_TEMPLATE_CACHE_TTL_SECONDS = 300
+# prompt name -> (expiry as time.monotonic(), prompt template with prefetched relations)
+_PROMPT_CACHE: dict[str, tuple[float, PromptTemplate]] = {}
+
+# How long an LLM config is skipped by new wrappers after it hit a rate limit
+LLM_CONFIG_RATE_LIMIT_COOLDOWN_SECONDS = 60
+# llm config name -> time.monotonic() until which it is skipped, shared by the process
+_COOLDOWN: dict[str, float] = {}
+
+
+def get_cached_prompt_template(prompt_name: str) -> PromptTemplate:
+    """
+    Returns the PromptTemplate with its tools and llm_config_names prefetched,
+    from the in-process cache if fetched within PROMPT_TEMPLATE_CACHE_TTL_SECONDS.
+    Raises PromptTemplate.DoesNotExist like PromptTemplate.objects.get.
+    """
+    cached = _PROMPT_CACHE.get(prompt_name)
+    now = time.monotonic()
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    prompt_template = PromptTemplate.objects.prefetch_related(
+        "tools", "llm_config_names"
+    ).get(name=prompt_name)
+    _PROMPT_CACHE[prompt_name] = (
+        now + PROMPT_TEMPLATE_CACHE_TTL_SECONDS,
+        prompt_template,
+    )
+    return prompt_template
+
+
+@functools.lru_cache(maxsize=256)
+def _template(template_string: str) -> Template:
+    # Prompt templates are stable, so parse each one only once
+    return Template(template_string)
+
+
+# JSON schema types of tool params, as produced by the admin form, to python types
+_JSON_SCHEMA_TO_PY_TYPE = {
+    "integer": int,
+    "string": str,
+    "boolean": bool,
+    "number": float,
+    "array": list,
+}
+
+
+@functools.lru_cache(maxsize=512)
+def _build_tool_args_struct(tool_name: str, params: tuple) -> type[msgspec.Struct]:
+    fields = []
+    for param_name, json_type, items_type in params:
+        py_type = _JSON_SCHEMA_TO_PY_TYPE[json_type]
+        if py_type is list and items_type == "string":
+            py_type = list[str]
+        fields.append((param_name, py_type))
+    # Unknown fields are rejected so that such calls take the generic path, as before
+    return msgspec.defstruct(f"{tool_name}Args", fields, forbid_unknown_fields=True)
+
+
+def _get_tool_args_struct(tool: Tool) -> type[msgspec.Struct] | None:
+    """
+    Returns a msgspec Struct mirroring the tool's argument schema, for decoding
+    tool call arguments in one typed pass. None if the schema can't be mirrored
+    exactly, i.e. it has optional params or types other than the mapped ones.
+    """
+    required = set(tool.tool_json_spec.get("parameters", {}).get("required", []))
+    params = []
+    for param_name, param_schema in tool.parsed_spec:
+        json_type = param_schema.get("type")
+        if param_name not in required or json_type not in _JSON_SCHEMA_TO_PY_TYPE:
+            return None
+        items_type = param_schema.get("items", {}).get("type")
+        params.append((param_name, json_type, items_type))
+    return _build_tool_args_struct(tool.name, tuple(params))
+
 
 class ValidLLMConfigs:
     AzureOpenAILLMConfig = "AzureOpenAILLMConfig"
@@ -36,13 +118,9 @@ class ValidLLMConfigs:
 
     @classmethod
     def check_llm_configs_in_db(cls) -> bool:
-        llm_configs_in_db = ValidLLMConfigs.get_all_llm_configs_from_db()
+        llm_configs_in_db = set(ValidLLMConfigs.get_all_llm_configs_from_db())
         loaded_configs = cls.get_all_valid_llm_configs()
-        missing_config_names = [
-            config_name
-            for config_name in llm_configs_in_db
-            if config_name not in loaded_configs
-        ]
+        missing_config_names = sorted(llm_configs_in_db - loaded_configs)
         if missing_config_names:
             raise ValueError(
                 f"The following configs are missing from the configuration, but defined in DB: {missing_config_names} "
@@ -58,6 +136,12 @@ class ChatHistoryRepository:
             self.chat_history_obj = ChatHistory.objects.create()
         else:
             self.chat_history_obj = ChatHistory.objects.get(id=chat_history_id)
+        # Msgs appended since the last write, which can be appended to the row in the DB
+        self._pending_appends: list = []
+        # Set when existing msgs changed in memory, so the whole chat_history must be written
+        self._needs_full_write = False
+        # get_msg_list_for_llm() projection of chat_history, kept in sync on writes
+        self._llm_view_cache: list[dict] | None = None
 
     @staticmethod
     def create_new_chat_history(*, initialize=True) -> ChatHistory:
@@ -70,27 +154,74 @@ class ChatHistoryRepository:
 
     def commit_chat_to_db(self):
         self.chat_history_obj.save()
+        self._pending_appends = []
+        self._needs_full_write = False
+
+    def flush_pending(self):
+        """
+        Writes pending chat_history changes with a single UPDATE, skipping model save.
+        If msgs were only appended, just those are sent and appended in postgres.
+        No-op if nothing changed since the last write.
+        """
+        if self._needs_full_write:
+            chat_history = self.chat_history_obj.chat_history
+        elif self._pending_appends:
+            chat_history = RawSQL(
+                "chat_history || %s::jsonb", [json.dumps(self._pending_appends)]
+            )
+        else:
+            return
+        now = timezone.now()
+        ChatHistory.objects.filter(pk=self.chat_history_obj.pk).update(
+            chat_history=chat_history, updated_at=now
+        )
+        self.chat_history_obj.updated_at = now
+        self._pending_appends = []
+        self._needs_full_write = False
 
     @staticmethod
-    def _generate_12_digit_random_id():
+    def _generate_12_digit_random_ids(count: int) -> list:
+        # One urandom draw for the whole batch, 6 bytes per id
         min_num = 10**11
-        max_num = (10**12) - 1
-        return random.randint(min_num, max_num)
+        num_range = 10**12 - min_num
+        random_bytes = os.urandom(6 * count)
+        return [
+            min_num + int.from_bytes(random_bytes[i : i + 6], "little") % num_range
+            for i in range(0, 6 * count, 6)
+        ]
+
+    @staticmethod
+    def get_msg_id(msg: dict):
+        """
+        Returns the id of a chat history msg, or None if it has none.
+        Older msgs store the id wrapped in a single element list.
+        """
+        msg_id = msg.get("id")
+        if isinstance(msg_id, list):
+            return msg_id[0] if msg_id else None
+        return msg_id
 
     def add_msgs_to_chat_history(
         self, msg_list: typing.List, timestamp: float = None, commit_to_db: bool = False
-    ) -> None:
-        ids = []
+    ) -> list:
         if not timestamp:
-            timestamp = round(datetime.now().timestamp(), 1)
-        for msg in msg_list:
+            timestamp = round(time.time(), 1)
+        ids = self._generate_12_digit_random_ids(len(msg_list))
+        for msg, id in zip(msg_list, ids):
             msg["timestamp"] = timestamp
-            id = (self._generate_12_digit_random_id(),)
             msg["id"] = id
-            ids.append(id)
+        if self._llm_view_cache is not None:
+            try:
+                self._llm_view_cache.extend(
+                    self._get_msg_for_llm(msg) for msg in msg_list
+                )
+            except (KeyError, ValueError):
+                # Left for get_msg_list_for_llm to rebuild, and raise on, when it's used
+                self._llm_view_cache = None
         self.chat_history_obj.chat_history.extend(msg_list)
+        self._pending_appends.extend(msg_list)
         if commit_to_db:
-            self.commit_chat_to_db()
+            self.flush_pending()
         return ids
 
     def _add_user_msg_to_chat_history(
@@ -100,30 +231,45 @@ class ChatHistoryRepository:
             msg_content=msg_content, msg_type="user", msg_timestamp=msg_timestamp
         )
 
-    def get_msg_list_for_llm(self) -> list:
-        msg_list = []
-        for msg in self.chat_history_obj.chat_history:
-            if msg["role"] in ["user", "assistant", "system"]:
-                new_msg = {"content": msg["content"], "role": msg["role"]}
-            elif msg["role"] == "tool":
-                new_msg = {
-                    "content": msg["content"],
-                    "role": "tool",
-                    "tool_call_id": msg["tool_call_id"],
-                    "name": msg["name"],
-                }
-            else:
-                raise ValueError(f"Unexpected msg role: {msg['role']}")
+    @staticmethod
+    def _get_msg_for_llm(msg: dict) -> dict:
+        if msg["role"] in ["user", "assistant", "system"]:
+            new_msg = {"content": msg["content"], "role": msg["role"]}
+        elif msg["role"] == "tool":
+            new_msg = {
+                "content": msg["content"],
+                "role": "tool",
+                "tool_call_id": msg["tool_call_id"],
+                "name": msg["name"],
+            }
+        else:
+            raise ValueError(f"Unexpected msg role: {msg['role']}")
 
-            if "tool_calls" in msg:
-                new_msg["tool_calls"] = msg["tool_calls"]
-            msg_list.append(new_msg)
-        return msg_list
+        if "tool_calls" in msg:
+            new_msg["tool_calls"] = msg["tool_calls"]
+        return new_msg
+
+    def get_msg_list_for_llm(self) -> list:
+        chat_history = self.chat_history_obj.chat_history
+        # The length check guards against chat_history being changed outside this class
+        if self._llm_view_cache is None or len(self._llm_view_cache) != len(
+            chat_history
+        ):
+            self._llm_view_cache = [
+                self._get_msg_for_llm(msg) for msg in chat_history
+            ]
+        # Copied since callers extend the returned list
+        return list(self._llm_view_cache)
 
     def add_or_update_system_msg(self, new_system_msg):
         if len(self.chat_history_obj.chat_history) > 0:
-            if self.chat_history_obj.chat_history[0]["role"] == "system":
-                self.chat_history_obj.chat_history[0]["content"] = new_system_msg
+            system_msg = self.chat_history_obj.chat_history[0]
+            if system_msg["role"] == "system":
+                if system_msg["content"] == new_system_msg:
+                    return
+                system_msg["content"] = new_system_msg
+                if self._llm_view_cache:
+                    self._llm_view_cache[0]["content"] = new_system_msg
             else:
                 raise ValueError(
                     f"Unexpected: First msg is not a system msg. Chat id: {self.chat_history_obj.id}"
@@ -132,41 +278,133 @@ class ChatHistoryRepository:
             self.chat_history_obj.chat_history = [
                 {"role": "system", "content": new_system_msg}
             ]
+            self._llm_view_cache = None
+        self._needs_full_write = True
 
     @staticmethod
     def get_chat_history_by_chat_id(chat_id):
-        try:
-            chat_history_obj = ChatHistory.objects.get(chat_id=chat_id)
-            return chat_history_obj.id
-        except ChatHistory.DoesNotExist:
-            return None
+        # Only the id is fetched, the chat_history blob is never loaded
+        return (
+            ChatHistory.objects.filter(chat_id=chat_id)
+            .values_list("id", flat=True)
+            .first()
+        )
 
-    def get_thumbs_counts(self) -> dict:
+    def get_stats(self) -> dict:
         """
-        Get counts of thumbs up (1) and thumbs down (-1) from chat history
-        Returns dict with keys 'thumbs_up' and 'thumbs_down'
+        Get counts of thumbs up (1), thumbs down (-1) and user messages in one pass over chat history
+        Returns dict with keys 'thumbs_up', 'thumbs_down' and 'user_msg_count'
         """
         thumbs_up = 0
         thumbs_down = 0
-
+        user_msg_count = 0
         for msg in self.chat_history_obj.chat_history:
-            thumb = msg.get("thumb")
+            get = msg.get
+            thumb = get("thumb")
             if thumb == 1:
                 thumbs_up += 1
             elif thumb == -1:
                 thumbs_down += 1
+            if get("role") == "user":
+                user_msg_count += 1
 
-        return {"thumbs_up": thumbs_up, "thumbs_down": thumbs_down}
+        return {
+            "thumbs_up": thumbs_up,
+            "thumbs_down": thumbs_down,
+            "user_msg_count": user_msg_count,
+        }
+
+    def get_thumbs_counts(self) -> dict:
+        """
+        Get counts of thumbs up (1) and thumbs down (-1) from chat history
+        Returns dict with keys 'thumbs_up' and 'thumbs_down'
+        """
+        stats = self.get_stats()
+        return {"thumbs_up": stats["thumbs_up"], "thumbs_down": stats["thumbs_down"]}
 
     def get_user_message_count(self) -> int:
         """
         Get count of messages where role='user' in chat history
         Returns int count of user messages
         """
-        return sum(
-            1 for msg in self.chat_history_obj.chat_history if msg.get("role") == "user"
+        return self.get_stats()["user_msg_count"]
+
+    @staticmethod
+    def _count_msgs_sql(condition: str) -> RawSQL:
+        return RawSQL(
+            "(SELECT count(*) FROM jsonb_array_elements("
+            f'"{ChatHistory._meta.db_table}"."chat_history") AS e WHERE {condition})',
+            [],
+        )
+
+    @staticmethod
+    def get_stats_from_db(chat_history_id: int) -> dict | None:
+        """
+        Same counts as get_stats, computed in postgres without loading the chat history
+        Returns None if no chat history exists with the given id
+        """
+        return (
+            ChatHistory.objects.filter(id=chat_history_id)
+            .annotate(
+                thumbs_up=ChatHistoryRepository._count_msgs_sql(
+                    "e->'thumb' = '1'::jsonb"
+                ),
+                thumbs_down=ChatHistoryRepository._count_msgs_sql(
+                    "e->'thumb' = '-1'::jsonb"
+                ),
+                user_msg_count=ChatHistoryRepository._count_msgs_sql(
+                    "e->>'role' = 'user'"
+                ),
+            )
+            .values("thumbs_up", "thumbs_down", "user_msg_count")
+            .first()
         )
 
+    @staticmethod
+    def get_chat_history_slice(chat_history_id: int, start: int, stop: int) -> list:
+        """
+        Returns chat_history[start:stop] of the given chat, sliced in postgres so only
+        the requested msgs are transferred and parsed. start and stop must be >= 0.
+        """
+        if stop <= start:
+            return []
+        chat_history = (
+            ChatHistory.objects.filter(id=chat_history_id)
+            .annotate(
+                msgs=RawSQL(
+                    "jsonb_path_query_array("
+                    f'"{ChatHistory._meta.db_table}"."chat_history", '
+                    "('$[' || %s || ' to ' || %s || ']')::jsonpath)",
+                    [str(start), str(stop - 1)],
+                )
+            )
+            .values_list("msgs", flat=True)
+            .first()
+        )
+        return chat_history or []
+
+    @staticmethod
+    def get_thumbs_counts_by_id(chat_history_id: int) -> dict | None:
+        """
+        get_thumbs_counts for a chat that isn't loaded, counted in postgres
+        Returns None if no chat history exists with the given id
+        """
+        stats = ChatHistoryRepository.get_stats_from_db(chat_history_id)
+        if stats is None:
+            return None
+        return {"thumbs_up": stats["thumbs_up"], "thumbs_down": stats["thumbs_down"]}
+
+    @staticmethod
+    def get_user_message_count_by_id(chat_history_id: int) -> int | None:
+        """
+        get_user_message_count for a chat that isn't loaded, counted in postgres
+        Returns None if no chat history exists with the given id
+        """
+        stats = ChatHistoryRepository.get_stats_from_db(chat_history_id)
+        if stats is None:
+            return None
+        return stats["user_msg_count"]
+
 
 class LLMCommunicationWrapper:
     class LLMConfigsNotAvailable(Exception):
@@ -175,17 +413,7 @@ class LLMCommunicationWrapper:
 
     @staticmethod
     def convert_to_function(source_code: str):
-        match = re.search(r"def\s+(\w+)\s*\(", source_code)
-        if match:
-            function_name = match.group(1)
-        else:
-            raise ValueError(
-                "No valid function definition found in the provided source code."
-            )
-        # Execute the source code in the current local scope
-        exec(source_code, locals())
-        # Retrieve and return the function by the extracted name
-        return locals()[function_name]
+        return compile_tool(source_code)
 
     @staticmethod
     def package_function_response(was_success, response_string, timestamp=None):
@@ -196,19 +424,38 @@ class LLMCommunicationWrapper:
             # "time": formatted_time,
         }
 
-        return json.dumps(packaged_message, ensure_ascii=False)
+        return orjson.dumps(packaged_message).decode()
 
     @staticmethod
     def parse_json(string) -> dict:
-        """Parse JSON string into JSON with both json and demjson"""
+        """Parse JSON string into JSON with orjson, falling back to json for input orjson rejects"""
         result = None
         try:
-            result = json.loads(string, strict=True)
+            try:
+                result = orjson.loads(string)
+            except orjson.JSONDecodeError:
+                # e.g. strings that are not valid UTF-8, such as lone surrogates
+                result = json.loads(string, strict=True)
             return result
         except Exception as e:
             print(f"Error parsing json with json package: {e}")
             raise e
 
+    @staticmethod
+    def parse_tool_arguments(arguments, args_struct=None) -> dict:
+        """
+        Parse tool call arguments, decoding straight into args_struct when given and
+        falling back to parse_json when the arguments don't match it
+        """
+        if args_struct is not None and isinstance(arguments, (str, bytes)):
+            try:
+                return msgspec.structs.asdict(
+                    msgspec.json.decode(arguments, type=args_struct)
+                )
+            except msgspec.DecodeError:
+                pass
+        return LLMCommunicationWrapper.parse_json(arguments)
+
     @staticmethod
     def get_tool_context_params(tool_function_name, context_vars, context_params):
         context_params_json = {}
@@ -229,7 +476,12 @@ class LLMCommunicationWrapper:
         if len(self.llm_config_names) == 0:
             raise LLMCommunicationWrapper.LLMConfigsNotAvailable()
 
-        random_llm_config_name = random.choice(self.llm_config_names)
+        now = time.monotonic()
+        # Configs that recently hit a rate limit are skipped, unless all of them did
+        candidates = [
+            name for name in self.llm_config_names if _COOLDOWN.get(name, 0) < now
+        ] or self.llm_config_names
+        random_llm_config_name = random.choice(candidates)
 
         self.llm_config_name = random_llm_config_name
 
@@ -257,22 +509,23 @@ class LLMCommunicationWrapper:
     ):
         self.prompt_name = prompt_name
         self.response_format_class = response_format_class
-        self.prompt_template = PromptTemplate.objects.get(name=prompt_name)
+        self.prompt_template = get_cached_prompt_template(prompt_name)
         self.chat_history_repository = ChatHistoryRepository(
             chat_history_id=chat_history_id
         )
 
-        self.tool_json_specs = [
-            {"type": "function", "function": tool.tool_json_spec}
-            for tool in self.prompt_template.tools.all()
-        ]
-        self.tool_callables = {
-            tool.name: LLMCommunicationWrapper.convert_to_function(tool.tool_code)
-            for tool in self.prompt_template.tools.all()
-        }
-        self.context_params = {
-            tool.name: tool.context_params for tool in self.prompt_template.tools.all()
-        }
+        self.tool_json_specs = []
+        self.tool_callables = {}
+        self.context_params = {}
+        self.tool_args_structs = {}
+        # Prefetched with the prompt template, so this is a single pass with no queries
+        for tool in self.prompt_template.tools.all():
+            self.tool_json_specs.append(
+                {"type": "function", "function": tool.tool_json_spec}
+            )
+            self.tool_callables[tool.name] = compile_tool(tool.tool_code)
+            self.context_params[tool.name] = tool.context_params
+            self.tool_args_structs[tool.name] = _get_tool_args_struct(tool)
 
         self.assistant_id = assistant_id
 
@@ -304,41 +557,45 @@ class LLMCommunicationWrapper:
     ):
         if initializing_context_vars is None:
             initializing_context_vars = {}
-        system_prompt = Template(
+        system_prompt = _template(
             self.prompt_template.system_prompt_template
         ).substitute(initializing_context_vars)
         init_msg_list = [{"role": "system", "content": system_prompt}]
-        for msg in self.prompt_template.initial_messages_templates:
-            init_msg_list.append(
-                {
-                    "content": Template(msg["content"]).substitute(
-                        initializing_context_vars
-                    ),
-                    "role": msg["role"],
-                    "system_generated": True,
-                    "show_in_user_history": False,
-                }
-            )
+        init_msg_list += [
+            {
+                "content": _template(msg["content"]).substitute(
+                    initializing_context_vars
+                ),
+                "role": msg["role"],
+                "system_generated": True,
+                "show_in_user_history": False,
+            }
+            for msg in self.prompt_template.initial_messages_templates
+        ]
         self.chat_history_repository.add_msgs_to_chat_history(init_msg_list)
         if commit_to_db:
-            self.chat_history_repository.commit_chat_to_db()
+            self.chat_history_repository.flush_pending()
 
-    def handle_tool_call(self, choice_from_llm, context_vars):
-        if choice_from_llm["message"].get("tool_calls") is None:
-            return {}
+    def handle_tool_call(self, choice_from_llm, context_vars, existing_msg_list=None):
+        """
+        Runs the tool requested in choice_from_llm, which must contain tool_calls, and
+        sends its output back to the LLM. existing_msg_list is the msg list the LLM was
+        called with, and is built from chat history if not given.
+        """
         tool_call_message = choice_from_llm["message"]
         tool_call_instancd = tool_call_message["tool_calls"][0]
         result = tool_call_instancd["function"]
         tool_call_id = tool_call_instancd["id"]
         tool_function_name = result.get("name", None)
+        chat_id = self.chat_history_repository.chat_history_obj.id
         if tool_function_name not in self.tool_callables:
             logger.error(
-                f"Unexpected tool call - {tool_function_name}. Chat id - {self.chat_history_repository.chat_history_obj.id}"
+                "Unexpected tool call - %s. Chat id - %s", tool_function_name, chat_id
             )
             return {}
         json_tool_function_params = result.get("arguments", {})
-        tool_function_params = LLMCommunicationWrapper.parse_json(
-            json_tool_function_params
+        tool_function_params = LLMCommunicationWrapper.parse_tool_arguments(
+            json_tool_function_params, self.tool_args_structs[tool_function_name]
         )
         context_params = self.context_params[tool_function_name]
         # Initialize context_params_json as an empty dictionary
@@ -349,15 +606,13 @@ class LLMCommunicationWrapper:
             tool_output = self.tool_callables[tool_function_name](
                 **context_params_json, **tool_function_params
             )
-            logger.info(f"Got tool output of {tool_function_name} - {tool_output}")
+            logger.info("Got tool output of %s - %s", tool_function_name, tool_output)
             tool_output_packaged = LLMCommunicationWrapper.package_function_response(
                 True, str(tool_output)
             )
-            logger.info(f"Generated packaged tool response = f{tool_output_packaged}")
+            logger.info("Generated packaged tool response = %s", tool_output_packaged)
         except Exception as exc:
-            logger.error(
-                f"Error in tool call - {exc}. Chat id - {self.chat_history_repository.chat_history_obj.id}"
-            )
+            logger.error("Error in tool call - %s. Chat id - %s", exc, chat_id)
             tool_output_packaged = LLMCommunicationWrapper.package_function_response(
                 False, "Got error in tool call"
             )
@@ -375,9 +630,10 @@ class LLMCommunicationWrapper:
             "name": tool_function_name,
             "content": tool_output_packaged,
         }
-        existing_msg_list = self.chat_history_repository.get_msg_list_for_llm()
+        if existing_msg_list is None:
+            existing_msg_list = self.chat_history_repository.get_msg_list_for_llm()
         new_msg_list = existing_msg_list + [tool_call_msg, our_tool_response]
-        a_time = datetime.now().timestamp()
+        a_time = time.monotonic()
         post_tool_call_response = OpenAIService.send_messages_and_get_response(
             new_msg_list,
             self.llm_config_params,
@@ -385,14 +641,14 @@ class LLMCommunicationWrapper:
         )
         post_tool_call_response_dict = {
             "role": "assistant",
-            "message_generation_time": round(datetime.now().timestamp() - a_time, 1),
+            "message_generation_time": round(time.monotonic() - a_time, 1),
             "content": post_tool_call_response["message"]["content"],
         }
         tool_call_msg["context_params"] = context_params_json
+        # Written to the DB by the caller, together with the user msg of this turn
         self.chat_history_repository.add_msgs_to_chat_history(
             [tool_call_msg, our_tool_response, post_tool_call_response_dict]
         )
-        self.chat_history_repository.commit_chat_to_db()
         tool_data = {
             "used_tool": tool_function_name,
             "tool_calls": [tool_call_instancd.dict()],
@@ -406,8 +662,7 @@ class LLMCommunicationWrapper:
         return modified_message_content
 
     def get_one_time_completion(self, kwargs):
-        # Fetch the prompt template from the database by name
-        prompt_template = PromptTemplate.objects.get(name=self.prompt_name)
+        prompt_template = self.prompt_template
 
         required_keys = prompt_template.required_kwargs
 
@@ -420,19 +675,14 @@ class LLMCommunicationWrapper:
             logging.error(error_message)
             raise ValueError(error_message)
 
-        # Access system_prompt and user_prompt fields
-        system_prompt = prompt_template.system_prompt_template
-        user_prompt = prompt_template.system_prompt_template
-
-        # Substitute values in the prompts using kwargs
-        formatted_system_prompt = system_prompt
-        formatted_user_prompt = user_prompt
-
-        for key, value in kwargs.items():
-            formatted_system_prompt = formatted_system_prompt.replace(
-                f"${key}", str(value)
-            )
-            formatted_user_prompt = formatted_user_prompt.replace(f"${key}", str(value))
+        # Substitute values in the prompts using kwargs, in a single pass per prompt
+        str_kwargs = {key: str(value) for key, value in kwargs.items()}
+        formatted_system_prompt = _template(
+            prompt_template.system_prompt_template
+        ).safe_substitute(str_kwargs)
+        formatted_user_prompt = _template(
+            prompt_template.user_prompt_template
+        ).safe_substitute(str_kwargs)
 
         combined_prompt = {
             "system_prompt": formatted_system_prompt,
@@ -444,7 +694,7 @@ class LLMCommunicationWrapper:
     def get_final_user_message(self, user_msg: str, context_vars=None) -> dict:
         user_prompt = user_msg
         if self.prompt_template.user_prompt_template:
-            user_prompt = Template(
+            user_prompt = _template(
                 self.prompt_template.user_prompt_template
             ).substitute(**context_vars, user_msg=user_msg)
         return {"role": "user", "content": user_prompt}
@@ -487,7 +737,7 @@ class LLMCommunicationWrapper:
                 }
             ]
         )
-        a_time = datetime.now().timestamp()
+        a_time = time.monotonic()
 
         while True:
             try:
@@ -498,6 +748,9 @@ class LLMCommunicationWrapper:
                 )
                 break
             except openai._exceptions.RateLimitError as e:
+                _COOLDOWN[self.llm_config_name] = (
+                    time.monotonic() + LLM_CONFIG_RATE_LIMIT_COOLDOWN_SECONDS
+                )
                 if retry_on_openai_time_limit:
                     self.llm_config_names.remove(self.llm_config_name)
                     self.init_llm_config()
@@ -505,7 +758,11 @@ class LLMCommunicationWrapper:
                     raise e
 
         if choice_response["message"].get("tool_calls") is not None:
-            return self.handle_tool_call(choice_response, context_vars)
+            response = self.handle_tool_call(
+                choice_response, context_vars, existing_msg_list=new_msg_list
+            )
+            self.chat_history_repository.flush_pending()
+            return response
         else:
             response_msg_content = choice_response["message"]["content"]
             msg_id = self.chat_history_repository.add_msgs_to_chat_history(
@@ -513,14 +770,14 @@ class LLMCommunicationWrapper:
                     {
                         "role": "assistant",
                         "message_generation_time": round(
-                            datetime.now().timestamp() - a_time, 1
+                            time.monotonic() - a_time, 1
                         ),
                         "content": response_msg_content,
                     }
                 ]
-            )[0][0]
+            )[0]
 
-            self.chat_history_repository.commit_chat_to_db()
+            self.chat_history_repository.flush_pending()
             response = {"message": response_msg_content, "id": msg_id}
             return response
 
@@ -528,7 +785,7 @@ class LLMCommunicationWrapper:
         if context_vars is None:
             context_vars = {}
         is_chat_history_empty = self.chat_history_repository.is_chat_history_empty()
-        system_prompt = Template(
+        system_prompt = _template(
             self.prompt_template.system_prompt_template
         ).substitute(**context_vars)
 
@@ -542,17 +799,79 @@ class LLMCommunicationWrapper:
     @staticmethod
     def update_message_thumb_rating(chat_history_obj, message_id, thumb):
         for msg in chat_history_obj.chat_history:
-            if msg.get("id") and msg["id"][0] == message_id:
-                msg["thumb"] = thumb
-                chat_history_obj.save()
-                return True
-        return False
+            msg_id = ChatHistoryRepository.get_msg_id(msg)
+            if msg_id is not None and msg_id == message_id:
+                break
+        else:
+            return False
+        # Matches the msg with the given id, in both the scalar and the older list form
+        msg_matches_sql = "COALESCE(e.msg->'id'->>0, e.msg->>'id') = %s"
+        # Set the thumb in place in postgres rather than re-writing the whole history.
+        # Rows whose stored history lacks the msg (e.g. appends not flushed yet) are
+        # skipped, since jsonb_set fails on a NULL path element.
+        updated_rows = (
+            ChatHistory.objects.filter(id=chat_history_obj.id)
+            .filter(
+                RawSQL(
+                    "EXISTS (SELECT 1 FROM jsonb_array_elements(chat_history) "
+                    f"WITH ORDINALITY AS e(msg, idx) WHERE {msg_matches_sql})",
+                    [str(message_id)],
+                    output_field=BooleanField(),
+                )
+            )
+            .update(
+                chat_history=RawSQL(
+                    "jsonb_set(chat_history, ARRAY[("
+                    "SELECT (e.idx - 1)::text FROM jsonb_array_elements(chat_history) "
+                    f"WITH ORDINALITY AS e(msg, idx) WHERE {msg_matches_sql} LIMIT 1"
+                    "), 'thumb'], %s::jsonb)",
+                    [str(message_id), json.dumps(thumb)],
+                ),
+                updated_at=timezone.now(),
+            )
+        )
+        if not updated_rows:
+            return False
+        msg["thumb"] = thumb
+        return True
 
     @staticmethod
     def get_processed_chat_messages(chat_history, is_superuser):
-        messages_list = []  # Initialize list to store processed messages
+        return list(
+            LLMCommunicationWrapper.iter_processed_chat_messages(
+                chat_history, is_superuser
+            )
+        )
+
+    @staticmethod
+    def get_processed_chat_messages_page(
+        chat_history_id: int, is_superuser, start: int, stop: int
+    ) -> list:
+        """
+        get_processed_chat_messages for chat_history[start:stop] of a chat that isn't
+        loaded. Only that slice, plus the msgs needed for tool info, is read from the DB.
+        """
+        # Tool info of a msg comes from the two msgs before it
+        context_start = max(0, start - 2)
+        chat_history = ChatHistoryRepository.get_chat_history_slice(
+            chat_history_id, context_start, stop
+        )
+        return list(
+            LLMCommunicationWrapper.iter_processed_chat_messages(
+                chat_history, is_superuser, start_index=start - context_start
+            )
+        )
+
+    @staticmethod
+    def iter_processed_chat_messages(chat_history, is_superuser, start_index=0):
+        """
+        Yields the msgs of get_processed_chat_messages one by one. Msgs before
+        start_index are only used as context for the tool info of later msgs.
+        """
         mapping = {"user": "user", "assistant": "bot"}
         for i, msg in enumerate(chat_history):
+            if i < start_index:
+                continue
             if msg.get("show_in_user_history", True) == False:
                 continue
             # Check if the message role is valid and it is not a tool call or initial message
@@ -563,11 +882,19 @@ class LLMCommunicationWrapper:
             ):
                 msg_type = mapping[msg["role"]]  # Map the role to its type
                 message_content = msg["content"]
-                try:
-                    json_content = json.loads(msg["content"])
-                    message_content = json_content.get("message", msg["content"])
-                except:
-                    message_content = msg["content"]
+                # Only content that looks like a JSON object is worth trying to parse
+                if isinstance(message_content, str):
+                    stripped_content = message_content.strip()
+                    if stripped_content.startswith("{") and stripped_content.endswith(
+                        "}"
+                    ):
+                        try:
+                            json_content = orjson.loads(stripped_content)
+                            message_content = json_content.get(
+                                "message", msg["content"]
+                            )
+                        except orjson.JSONDecodeError:
+                            pass
                 extra = {}  # Initialize extra information dictionary
 
                 # If the user is a superuser, include tool information
@@ -581,18 +908,13 @@ class LLMCommunicationWrapper:
                         "tool_content": content,
                     }
 
-                # Append the message and additional information to the list
-                messages_list.append(
-                    {
-                        "message": message_content,
-                        "type": msg_type,
-                        "tool_data": extra,
-                        "id": msg["id"][0],
-                        "thumb": msg.get("thumb", None),
-                    }
-                )
-
-        return messages_list
+                yield {
+                    "message": message_content,
+                    "type": msg_type,
+                    "tool_data": extra,
+                    "id": ChatHistoryRepository.get_msg_id(msg),
+                    "thumb": msg.get("thumb", None),
+                }
 
 
 class ABTestingLLMCommunicationWrapper(LLMCommunicationWrapper):
@@ -643,7 +965,7 @@ class ABTestingLLMCommunicationWrapper(LLMCommunicationWrapper):
         try:
             # Fetch the feature flag value for the user
             feature_flag_variant_name = (
-                ExperimentHelper().get_feature_flag_variant_name(
+                get_default_experiment_helper().get_feature_flag_variant_name(
                     flag_key=experiment_name, user_id=self.user_id
                 )
             )
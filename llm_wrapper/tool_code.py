@@ -0,0 +1,26 @@
+import functools
+import re
+import typing
+
+_FUNC_DEF_RE = re.compile(r"def\s+(\w+)\s*\(")
+
+
+@functools.lru_cache(maxsize=512)
+def compile_tool(source_code: str) -> typing.Callable:
+    """
+    Compiles and executes tool source code, returning the function it defines.
+    Cached by source, so each distinct tool is only exec'd once per process.
+    """
+    match = _FUNC_DEF_RE.search(source_code)
+    if match:
+        function_name = match.group(1)
+    else:
+        raise ValueError(
+            "No valid function definition found in the provided source code."
+        )
+    code = compile(source_code, f"<tool:{function_name}>", "exec")
+    # Execute the code in a fresh namespace
+    namespace = {}
+    exec(code, namespace)
+    # Retrieve and return the function by the extracted name
+    return namespace[function_name]